@@ -1,12 +1,60 @@
+import hashlib
+import html
 import json
 import os
+import re
 import smtplib
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from email.message import EmailMessage
 from email.utils import parseaddr, formataddr
 
+# Reconnect after this many messages so a long batch does not trip per-connection
+# limits enforced by some SMTP providers.
+SMTP_MAX_MESSAGES_PER_CONNECTION = 50
+
+# Sent-state keys are fixed-width BLAKE2b digests of the readable event id.
+_HASHED_KEY_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# Static scaffold of the HTML email body; only the heading and table rows vary.
+_HTML_TEMPLATE = """
+<html>
+<head>
+  <style>
+    body {{ font-family: Arial, sans-serif; color: #222; }}
+    .card {{ max-width: 640px; border: 1px solid #e5e5e5; border-radius: 8px; padding: 16px; box-shadow: 0 2px 6px rgba(0,0,0,0.05); }}
+    h2 {{ margin: 0 0 12px 0; font-size: 20px; color: #1a4d8f; }}
+    table {{ width: 100%; border-collapse: collapse; }}
+    td {{ padding: 8px 6px; vertical-align: top; }}
+    .label {{ width: 80px; font-weight: bold; color: #555; }}
+    .value {{ color: #222; }}
+    a {{ color: #1a4d8f; text-decoration: none; }}
+    a:hover {{ text-decoration: underline; }}
+  </style>
+</head>
+<body>
+  <div class="card">
+    <h2>{subject}</h2>
+    <table>
+      {rows}
+    </table>
+  </div>
+</body>
+</html>
+""".strip()
+
 
 class SeminarEmailNotifier:
+    _ICS_HEADER = (
+        "BEGIN:VCALENDAR",
+        "PRODID:-//HKU CS Seminar Sync//EN",
+        "VERSION:2.0",
+        "CALSCALE:GREGORIAN",
+        "METHOD:REQUEST",
+        "BEGIN:VEVENT",
+    )
+    _ICS_ATTENDEE_PARAMS = ";RSVP=TRUE;PARTSTAT=NEEDS-ACTION;ROLE=REQ-PARTICIPANT"
+
     def __init__(
         self,
         *,
@@ -148,59 +196,119 @@ class SeminarEmailNotifier:
         if not self.to_emails:
             raise RuntimeError("Recipient list is empty. Set HKU_TO_EMAILS.")
 
-    def send_new_invites(self, seminars: list[dict]) -> int:
+    def send_new_invites(self, seminars: list, sent=None) -> int:
+        """
+        Email an invite for every seminar whose key is not in ``sent`` and
+        record it. ``sent`` defaults to the keys from load_sent_keys(); pass a
+        set that was already loaded to avoid reading the state file twice.
+        """
         self.ensure_ready()
-        sent = self._load_sent_keys()
+        if sent is None:
+            sent = self.load_sent_keys()
         new_count = 0
+        # One DTSTAMP for the whole batch: it records when the invites were
+        # generated, so there is no need to re-read the clock per message.
+        dtstamp = self._format_ics_datetime(datetime.now(tz=timezone.utc))
 
-        for seminar in seminars:
-            key = self._event_key(seminar)
-            if key in sent:
-                continue
+        # Every send is appended to the journal right away so progress survives
+        # a crash; the full state file is rewritten exactly once, at the end of
+        # the batch (also when it is aborted by an error).
+        dirty = False
+        journal = None
+        try:
+            # The SMTP connection is opened lazily by the session, so a run with
+            # nothing new to send never touches the server.
+            with self._smtp_session() as send:
+                for seminar in seminars:
+                    key = self.event_key(seminar)
+                    if key in sent:
+                        continue
 
-            msg = self._build_email_message(seminar)
-            self._send_email(msg)
-            sent.add(key)
-            self._save_sent_keys(sent)  # flush per send to avoid losing progress
-            new_count += 1
-            print(
-                f"Sent invite for: {seminar['title']} "
-                f"({seminar['start']:%Y-%m-%d %H:%M})"
-            )
+                    msg = self._build_email_message(seminar, dtstamp)
+                    self._send_email(send, msg)
+                    sent.add(key)
+                    dirty = True
+                    if journal is None:
+                        journal = open(
+                            self._journal_file, "a", encoding="utf-8", buffering=1
+                        )
+                    journal.write(json.dumps(key, ensure_ascii=False) + "\n")
+                    new_count += 1
+                    print(
+                        f"Sent invite for: {seminar.title} "
+                        f"({seminar.start:%Y-%m-%d %H:%M})"
+                    )
+        finally:
+            if journal is not None:
+                journal.close()
+            if dirty:
+                self._save_sent_keys(sent)
         return new_count
 
-    def _event_key(self, seminar):
+    def event_key(self, seminar):
+        return self._hash_key(self._event_id(seminar))
+
+    def _event_id(self, seminar):
         return (
-            f"{seminar['title']}|{seminar['speaker']}|"
-            f"{seminar['start'].isoformat()}"
+            f"{seminar.title}|{seminar.speaker}|"
+            f"{seminar.start.isoformat()}"
         )
 
-    def _load_sent_keys(self):
-        if not os.path.exists(self.state_file):
-            return set()
-        try:
-            with open(self.state_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            return set(data)
-        except (json.JSONDecodeError, OSError) as exc:
-            print(f"Warning: failed to read {self.state_file}: {exc}")
-            return set()
+    @staticmethod
+    def _hash_key(event_id: str) -> str:
+        return hashlib.blake2b(event_id.encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def _journal_file(self):
+        return f"{os.path.splitext(self.state_file)[0]}.jsonl"
+
+    def load_sent_keys(self):
+        keys = set()
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, "r", encoding="utf-8") as f:
+                    keys.update(json.load(f))
+            except (json.JSONDecodeError, OSError) as exc:
+                print(f"Warning: failed to read {self.state_file}: {exc}")
+        # Keys sent by a run that stopped before rewriting the state file.
+        if os.path.exists(self._journal_file):
+            try:
+                with open(self._journal_file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            keys.add(json.loads(line))
+                        except json.JSONDecodeError:
+                            # A torn final line from an interrupted write.
+                            continue
+            except OSError as exc:
+                print(f"Warning: failed to read {self._journal_file}: {exc}")
+
+        # One-time migration of state written before keys were hashed.
+        legacy = {key for key in keys if not _HASHED_KEY_RE.match(key)}
+        if legacy:
+            keys -= legacy
+            keys.update(self._hash_key(key) for key in legacy)
+            print(f"Migrating {len(legacy)} legacy key(s) in {self.state_file}.")
+            self._save_sent_keys(keys)
+        return keys
 
     def _save_sent_keys(self, keys):
         tmp_path = f"{self.state_file}.tmp"
         with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(sorted(keys), f, ensure_ascii=False, indent=2)
         os.replace(tmp_path, self.state_file)
+        # Everything in the journal is now part of the state file.
+        if os.path.exists(self._journal_file):
+            os.remove(self._journal_file)
 
     def _format_ics_datetime(self, dt: datetime) -> str:
-        return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-
-    def _build_single_ics(self, seminar, dtstamp: str) -> str:
-        uid = self._event_key(seminar) + "@hku-cs"
-        dtstart = self._format_ics_datetime(seminar["start"])
-        dtend = self._format_ics_datetime(seminar["end"])
-        subject = f"{self.subject_prefix}{seminar['title']} — {seminar['speaker']}"
+        return f"{dt.astimezone(timezone.utc):%Y%m%dT%H%M%SZ}"
 
+    def _build_single_ics(self, seminar, subject: str, dtstamp: str) -> str:
+        # Keep the readable id as UID so it stays stable across state formats.
+        uid = self._event_id(seminar) + "@hku-cs"
+        dtstart = self._format_ics_datetime(seminar.start)
+        dtend = self._format_ics_datetime(seminar.end)
         # Parse organizer (may be in "Name <email>" format)
         org_name, org_email = parseaddr(self.from_email)
         organizer_email = org_email or self.from_email
@@ -209,21 +317,18 @@ class SeminarEmailNotifier:
             safe_name = org_name.replace('"', '\\"')
             organizer_param = f';CN="{safe_name}"'
 
-        description = (
-            f"Speaker: {seminar['speaker']}\\n"
-            f"Venue: {seminar['venue']}\\n"
-            f"Source: {self.source_url}"
-        )
-        if seminar.get("link"):
-            description += f"\\nPoster: {seminar['link']}"
+        desc_parts = [
+            f"Speaker: {seminar.speaker}",
+            f"Venue: {seminar.venue}",
+            f"Source: {self.source_url}",
+        ]
+        if seminar.link:
+            desc_parts.append(f"Poster: {seminar.link}")
+        # ICS text values encode line breaks as a literal "\\n".
+        description = "\\n".join(desc_parts)
 
         lines = [
-            "BEGIN:VCALENDAR",
-            "PRODID:-//HKU CS Seminar Sync//EN",
-            "VERSION:2.0",
-            "CALSCALE:GREGORIAN",
-            "METHOD:REQUEST",
-            "BEGIN:VEVENT",
+            *self._ICS_HEADER,
             f"UID:{uid}",
             "SEQUENCE:0",
             "STATUS:CONFIRMED",
@@ -232,7 +337,7 @@ class SeminarEmailNotifier:
             f"DTSTAMP:{dtstamp}",
             f"DTSTART:{dtstart}",
             f"DTEND:{dtend}",
-            f"LOCATION:{seminar['venue']}",
+            f"LOCATION:{seminar.venue}",
             f"DESCRIPTION:{description}",
         ]
         lines.append(f"ORGANIZER{organizer_param}:MAILTO:{organizer_email}")
@@ -242,23 +347,20 @@ class SeminarEmailNotifier:
             att_name, att_email = parseaddr(attendee)
             if not att_email:
                 continue
-            params = []
+            cn_param = ""
             if att_name:
                 safe_name = att_name.replace('"', '\\"')
-                params.append(f'CN="{safe_name}"')
-            params.extend(
-                ["RSVP=TRUE", "PARTSTAT=NEEDS-ACTION", "ROLE=REQ-PARTICIPANT"]
+                cn_param = f';CN="{safe_name}"'
+            lines.append(
+                f"ATTENDEE{cn_param}{self._ICS_ATTENDEE_PARAMS}:MAILTO:{att_email}"
             )
-            param_str = ";".join(params)
-            lines.append(f"ATTENDEE;{param_str}:MAILTO:{att_email}")
 
         lines.extend(["PRIORITY:5", "CLASS:PUBLIC", "END:VEVENT", "END:VCALENDAR", ""])
         return "\r\n".join(lines)
 
-    def _build_email_message(self, seminar: dict):
-        dtstamp = self._format_ics_datetime(datetime.now(tz=timezone.utc))
+    def _build_email_message(self, seminar, dtstamp: str):
         per_event_subject = (
-            f"{self.subject_prefix}{seminar['title']} — {seminar['speaker']}"
+            f"{self.subject_prefix}{seminar.title} — {seminar.speaker}"
         )
         msg = EmailMessage()
         msg["Subject"] = self.subject_override or per_event_subject
@@ -279,58 +381,45 @@ class SeminarEmailNotifier:
         if sender_email:
             msg["Sender"] = formataddr((sender_name, sender_email))
 
-        body = (
-            f"{seminar['title']} — {seminar['speaker']}\n"
-            f"Time: {seminar['start'].strftime('%Y-%m-%d %H:%M')} - "
-            f"{seminar['end'].strftime('%H:%M')} ({self.tz.key})\n"
-            f"Venue: {seminar['venue']}\n"
-            f"Source: {self.source_url}\n"
-        )
-        if seminar.get("link"):
-            body += f"Poster: {seminar['link']}\n"
-        msg.set_content(body)
-
-        rows_html = [
-            f"<tr><td class='label'>Title</td><td class='value'>{seminar['title']}</td></tr>",
-            f"<tr><td class='label'>Speaker</td><td class='value'>{seminar['speaker']}</td></tr>",
-            f"<tr><td class='label'>Time</td><td class='value'>{seminar['start'].strftime('%Y-%m-%d %H:%M')} - {seminar['end'].strftime('%H:%M')} ({self.tz.key})</td></tr>",
-            f"<tr><td class='label'>Venue</td><td class='value'>{seminar['venue']}</td></tr>",
-            f"<tr><td class='label'>Source</td><td class='value'><a href='{self.source_url}'>{self.source_url}</a></td></tr>",
+        body_lines = [
+            f"{seminar.title} — {seminar.speaker}",
+            f"Time: {seminar.start.strftime('%Y-%m-%d %H:%M')} - "
+            f"{seminar.end.strftime('%H:%M')} ({self.tz.key})",
+            f"Venue: {seminar.venue}",
+            f"Source: {self.source_url}",
         ]
-        if seminar.get("link"):
-            rows_html.append(
-                f"<tr><td class='label'>Poster</td><td class='value'><a href='{seminar['link']}'>{seminar['link']}</a></td></tr>"
-            )
+        if seminar.link:
+            body_lines.append(f"Poster: {seminar.link}")
+        body_lines.append("")
+        msg.set_content("\n".join(body_lines))
 
-        html = f"""
-<html>
-<head>
-  <style>
-    body {{ font-family: Arial, sans-serif; color: #222; }}
-    .card {{ max-width: 640px; border: 1px solid #e5e5e5; border-radius: 8px; padding: 16px; box-shadow: 0 2px 6px rgba(0,0,0,0.05); }}
-    h2 {{ margin: 0 0 12px 0; font-size: 20px; color: #1a4d8f; }}
-    table {{ width: 100%; border-collapse: collapse; }}
-    td {{ padding: 8px 6px; vertical-align: top; }}
-    .label {{ width: 80px; font-weight: bold; color: #555; }}
-    .value {{ color: #222; }}
-    a {{ color: #1a4d8f; text-decoration: none; }}
-    a:hover {{ text-decoration: underline; }}
-  </style>
-</head>
-<body>
-  <div class="card">
-    <h2>{per_event_subject}</h2>
-    <table>
-      {''.join(rows_html)}
-    </table>
-  </div>
-</body>
-</html>
-""".strip()
-        msg.add_alternative(html, subtype="html")
+        # Page-sourced fields are escaped before being placed in the HTML body.
+        title = html.escape(seminar.title)
+        speaker = html.escape(seminar.speaker)
+        venue = html.escape(seminar.venue)
+        source = html.escape(self.source_url)
+        link = html.escape(seminar.link) if seminar.link else None
+        poster_row = (
+            f"<tr><td class='label'>Poster</td><td class='value'><a href='{link}'>{link}</a></td></tr>"
+            if link
+            else ""
+        )
+        rows = (
+            f"<tr><td class='label'>Title</td><td class='value'>{title}</td></tr>"
+            f"<tr><td class='label'>Speaker</td><td class='value'>{speaker}</td></tr>"
+            f"<tr><td class='label'>Time</td><td class='value'>{seminar.start.strftime('%Y-%m-%d %H:%M')} - {seminar.end.strftime('%H:%M')} ({self.tz.key})</td></tr>"
+            f"<tr><td class='label'>Venue</td><td class='value'>{venue}</td></tr>"
+            f"<tr><td class='label'>Source</td><td class='value'><a href='{source}'>{source}</a></td></tr>"
+            f"{poster_row}"
+        )
+
+        html_body = _HTML_TEMPLATE.format(
+            subject=html.escape(per_event_subject), rows=rows
+        )
+        msg.add_alternative(html_body, subtype="html")
 
         msg.make_mixed()
-        ics_text = self._build_single_ics(seminar, dtstamp)
+        ics_text = self._build_single_ics(seminar, per_event_subject, dtstamp)
         cal_part = EmailMessage()
         cal_part.set_content(ics_text, subtype="calendar", charset="utf-8")
         cal_part.replace_header(
@@ -349,17 +438,66 @@ class SeminarEmailNotifier:
         return formataddr((name, email)) if email else addr
 
 
-    def _send_email(self, msg: EmailMessage):
+    def _send_email(self, send, msg: EmailMessage):
         to_header = msg.get("To", "")
         recipients = [addr.strip() for addr in to_header.split(",") if addr.strip()]
         print(f"About to send email to: {to_header}")
         if recipients:
             print(f"Recipient list ({len(recipients)}): {recipients}")
+        send(msg)
 
+    def _open_smtp(self):
         smtp_class = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
-        with smtp_class(self.smtp_host, self.smtp_port) as smtp:
+        smtp = smtp_class(self.smtp_host, self.smtp_port)
+        try:
             if self.use_starttls and not self.use_ssl:
                 smtp.starttls()
             if self.smtp_user and self.smtp_password:
                 smtp.login(self.smtp_user, self.smtp_password)
-            smtp.send_message(msg)
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    @staticmethod
+    def _close_smtp(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    @contextmanager
+    def _smtp_session(self):
+        """
+        Yield a ``send(msg)`` callable that shares one SMTP connection.
+
+        The connection is opened on the first send, recycled every
+        SMTP_MAX_MESSAGES_PER_CONNECTION messages, and re-established once if
+        the server dropped it (e.g. idle timeout) before a message went out.
+        """
+        smtp = None
+        sent_on_connection = 0
+
+        def send(msg: EmailMessage):
+            nonlocal smtp, sent_on_connection
+            if smtp is not None and sent_on_connection >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+                self._close_smtp(smtp)
+                smtp = None
+            if smtp is None:
+                smtp = self._open_smtp()
+                sent_on_connection = 0
+            try:
+                smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                print("SMTP connection was closed by the server, reconnecting...")
+                smtp.close()
+                smtp = self._open_smtp()
+                sent_on_connection = 0
+                smtp.send_message(msg)
+            sent_on_connection += 1
+
+        try:
+            yield send
+        finally:
+            if smtp is not None:
+                self._close_smtp(smtp)
@@ -1,7 +1,10 @@
 import os
+import pickle
 import re
 import sys
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+from typing import NamedTuple, Optional
 from urllib.parse import urljoin
 
 try:
@@ -13,7 +16,9 @@ except ImportError as exc:  # pragma: no cover - fallback message
     ) from exc
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
 
 from email_notifier import SeminarEmailNotifier
 
@@ -23,12 +28,87 @@ HK_TZ = ZoneInfo("Asia/Hong_Kong")
 HKU_SEMINAR_URL = "https://www.cs.hku.hk/programmes/research-based/mphil-phd-courses-offered"
 SUBJECT_PREFIX = "[HKU CS Seminar] "
 
+# Validators (ETag / Last-Modified) and the parsed seminar list of the last
+# download, so an unchanged page costs a 304 and no parsing.
+PAGE_CACHE_FILE = os.environ.get("HKU_PAGE_CACHE_FILE", "hku_page_cache.pickle")
+# Bump whenever the shape of the parsed seminar records changes.
+PAGE_CACHE_VERSION = 2
+
 MIN_SEMINAR_DURATION = timedelta(minutes=20)
 MAX_SEMINAR_DURATION = timedelta(hours=4)
 SUSPICIOUS_LONG_DURATION = timedelta(hours=6)
 NOON_AMBIGUOUS_HOURS = {11, 12}
 
 
+class Seminar(NamedTuple):
+    """One row of the HKU seminar table; start/end are Asia/Hong_Kong aware."""
+
+    title: str
+    speaker: str
+    start: datetime
+    end: datetime
+    venue: str
+    link: Optional[str] = None
+
+
+# Keep-alive session reused for every request to the HKU site. Transient
+# failures (rate limiting, 5xx) are retried with exponential back-off, honouring
+# Retry-After; if they persist, raise_for_status() still reports them.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+    ),
+)
+
+# Only headings and tables are needed to find the schedule, so skip building
+# the rest of the page (navigation, scripts, footer) into the tree.
+_SEMINAR_STRAINER = SoupStrainer(["h2", "table"])
+
+# Matches on the heading's full text, like get_text(); soupsieve caches the
+# compiled selector across calls.
+_SCHEDULE_HEADING_SELECTOR = "h2:-soup-contains('Schedule of the seminars')"
+
+_DATE_FMT = "%B %d, %Y"
+_TIME_RE = re.compile(
+    r"^(\d{1,2})(?::(\d{2}))?\s*(?:([ap])\.?\s*m\.?|nn|noon)$", re.IGNORECASE
+)
+
+
+# Many seminars share a date or a start/end time, so the parsed values are
+# memoised per distinct string.
+@lru_cache(maxsize=512)
+def _parse_date(date_str: str):
+    return datetime.strptime(date_str, _DATE_FMT).date()
+
+
+@lru_cache(maxsize=512)
+def _parse_time(t: str):
+    """
+    Parse one endpoint such as "10:00am", "5 pm", "2:00 p.m." or "12:00 nn"
+    ("nn"/"noon" count as pm). Returns (time, meridiem, hour12).
+    """
+    match = _TIME_RE.match(t)
+    if not match:
+        raise ValueError(f"Unexpected time format: {t!r}")
+    hour12 = int(match.group(1))
+    minute = int(match.group(2) or 0)
+    if not 1 <= hour12 <= 12 or minute > 59:
+        raise ValueError(f"Unexpected time format: {t!r}")
+    ap = match.group(3)
+    meridiem = "am" if ap and ap.lower() == "a" else "pm"
+    hour = hour12 % 12 + (12 if meridiem == "pm" else 0)
+    return time(hour, minute), meridiem, hour12
+
+
 def parse_datetime_range(date_str: str, time_range_str: str):
     """
     输入:
@@ -37,8 +117,7 @@ def parse_datetime_range(date_str: str, time_range_str: str):
     返回:
         start_dt, end_dt (带 Asia/Hong_Kong 时区的 datetime)
     """
-    date_str = date_str.strip()
-    date = datetime.strptime(date_str, "%B %d, %Y").date()
+    date = _parse_date(date_str.strip())
 
     if not time_range_str:
         # 如果网页上没有时间，默认全天事件（一般不会发生）
@@ -52,36 +131,11 @@ def parse_datetime_range(date_str: str, time_range_str: str):
     if len(parts) != 2:
         raise ValueError(f"Unexpected time range format: {time_range_str}")
 
-    def parse_time(t: str):
-        t = t.strip().lower()
-        # Normalize "p.m."/"a.m." variants before further processing.
-        t = re.sub(r"([ap])\.?\s*m\.?", r"\1m", t)
-        # "12:00 nn" 处理成 12:00 pm
-        t = t.replace("nn", "pm")
-        t = t.replace(" noon", " pm")
-        # 有的写法可能是 "10:00am" 中间没空格，统一加空格
-        if "am" in t and " " not in t:
-            t = t.replace("am", " am")
-        if "pm" in t and " " not in t:
-            t = t.replace("pm", " pm")
-        meridiem = None
-        if " am" in t:
-            meridiem = "am"
-        elif " pm" in t:
-            meridiem = "pm"
-        for time_format in ("%I:%M %p", "%I %p"):
-            try:
-                parsed_time = datetime.strptime(t, time_format).time()
-                break
-            except ValueError:
-                pass
-        else:
-            raise ValueError(f"Unexpected time format: {t!r} in range {time_range_str!r}")
-        hour12 = parsed_time.hour % 12 or 12
-        return parsed_time, meridiem, hour12
-
-    start_time, start_meridiem, _start_hour12 = parse_time(parts[0])
-    end_time, end_meridiem, end_hour12 = parse_time(parts[1])
+    try:
+        start_time, start_meridiem, _start_hour12 = _parse_time(parts[0].strip())
+        end_time, end_meridiem, end_hour12 = _parse_time(parts[1].strip())
+    except ValueError as exc:
+        raise ValueError(f"{exc} in range {time_range_str!r}") from None
 
     start_dt = datetime.combine(date, start_time).replace(tzinfo=HK_TZ)
     end_dt = datetime.combine(date, end_time).replace(tzinfo=HK_TZ)
@@ -123,30 +177,88 @@ def parse_datetime_range(date_str: str, time_range_str: str):
     return start_dt, end_dt
 
 
+def _parse_html(content: bytes):
+    # lxml is a C parser and much faster than the pure-Python "html.parser";
+    # pass raw bytes so the parser detects the page encoding itself.
+    try:
+        return BeautifulSoup(content, "lxml", parse_only=_SEMINAR_STRAINER)
+    except FeatureNotFound:
+        return BeautifulSoup(content, "html.parser", parse_only=_SEMINAR_STRAINER)
+
+
+def _load_page_cache():
+    if not os.path.exists(PAGE_CACHE_FILE):
+        return None
+    try:
+        with open(PAGE_CACHE_FILE, "rb") as f:
+            cache = pickle.load(f)
+    except Exception as exc:  # any unpickling failure just means a cold fetch
+        print(f"Warning: failed to read {PAGE_CACHE_FILE}: {exc}")
+        return None
+    if not isinstance(cache, dict) or cache.get("version") != PAGE_CACHE_VERSION:
+        return None
+    return cache
+
+
+def _save_page_cache(headers, seminars):
+    etag = headers.get("ETag")
+    last_modified = headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return
+    cache = {
+        "version": PAGE_CACHE_VERSION,
+        "etag": etag,
+        "last_modified": last_modified,
+        "seminars": seminars,
+    }
+    tmp_path = f"{PAGE_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache, f)
+        os.replace(tmp_path, PAGE_CACHE_FILE)
+    except (OSError, pickle.PicklingError) as exc:
+        print(f"Warning: failed to write {PAGE_CACHE_FILE}: {exc}")
+
+
 def fetch_seminars():
     """
-    从 HKU CS 网站抓取 seminars 表格，返回列表：
-    [
-        {
-            "title": ...,
-            "speaker": ...,
-            "start": datetime,
-            "end": datetime,
-            "venue": ...
-        },
-        ...
-    ]
+    从 HKU CS 网站抓取 seminars 表格，返回 Seminar 列表。
+    """
+    return list(fetch_seminars_iter())
+
+
+def fetch_seminars_iter():
+    """
+    与 fetch_seminars 相同，但逐个 yield seminar，调用方可以边解析边过滤。
+    页面缓存只在完整迭代后写入。
     """
-    resp = requests.get(HKU_SEMINAR_URL, timeout=20)
+    cache = _load_page_cache()
+    headers = {}
+    if cache:
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+    resp = _SESSION.get(HKU_SEMINAR_URL, timeout=20, headers=headers)
+    if resp.status_code == 304 and cache:
+        print("Seminar page not modified since last run, using cached seminar list.")
+        yield from cache["seminars"]
+        return
     resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
 
-    # 找到 "Schedule of the seminars" 对应的 h2
-    h2 = None
-    for tag in soup.find_all("h2"):
-        if "Schedule of the seminars" in tag.get_text():
-            h2 = tag
-            break
+    seminars = []
+    for seminar in _iter_seminar_page(resp.content):
+        seminars.append(seminar)
+        yield seminar
+    _save_page_cache(resp.headers, seminars)
+
+
+def _iter_seminar_page(content: bytes):
+    soup = _parse_html(content)
+
+    # 找到 "Schedule of the seminars" 对应的 h2（命中第一个即停止）
+    h2 = soup.select_one(_SCHEDULE_HEADING_SELECTOR)
 
     if not h2:
         raise RuntimeError("Cannot find 'Schedule of the seminars' heading on the page.")
@@ -155,10 +267,9 @@ def fetch_seminars():
     if not table:
         raise RuntimeError("Cannot find seminar table following the heading.")
 
-    seminars = []
     rows = table.find_all("tr")
     if not rows:
-        return seminars
+        return
 
     # 第一行是表头，跳过
     for tr in rows[1:]:
@@ -201,54 +312,64 @@ def fetch_seminars():
         # Venue
         venue = tds[3].get_text(strip=True)
 
-        seminars.append(
-            {
-                "title": title,
-                "speaker": speaker,
-                "start": start_dt,
-                "end": end_dt,
-                "venue": venue,
-                "link": link,
-            }
+        yield Seminar(
+            title=title,
+            speaker=speaker,
+            start=start_dt,
+            end=end_dt,
+            venue=venue,
+            link=link,
         )
 
-    return seminars
-
 
 def print_seminar_overview(seminars):
     print("Seminar list:")
     for s in seminars:
-        start_str = s["start"].strftime("%Y-%m-%d %H:%M")
-        end_str = s["end"].strftime("%H:%M")
+        start_str = s.start.strftime("%Y-%m-%d %H:%M")
+        end_str = s.end.strftime("%H:%M")
         print(
-            f" - {s['title']} | {s['speaker']} | "
-            f"{start_str}-{end_str} ({HK_TZ.key}) | {s['venue']}"
+            f" - {s.title} | {s.speaker} | "
+            f"{start_str}-{end_str} ({HK_TZ.key}) | {s.venue}"
         )
     print(f"Total {len(seminars)} seminar(s).\n")
 
 
 def sync_seminars_via_email():
-    seminars = fetch_seminars()
-    if not seminars:
-        print("No seminars found on the page.")
-        return
+    notifier = SeminarEmailNotifier.from_config_file(
+        os.environ.get("HKU_CONFIG_PATH", "config.json"),
+        tz=HK_TZ,
+        source_url=HKU_SEMINAR_URL,
+        subject_prefix=SUBJECT_PREFIX,
+    )
+    sent = notifier.load_sent_keys()
 
+    # Filter while parsing so already-notified seminars never reach the
+    # email builder; rows duplicated on the page are only queued once.
     now_hk = datetime.now(HK_TZ)
-    upcoming = [s for s in seminars if s["end"] >= now_hk]
+    total = 0
+    upcoming = []
+    queued = set()
+    for s in fetch_seminars_iter():
+        total += 1
+        if s.end < now_hk:
+            continue
+        key = notifier.event_key(s)
+        if key in sent or key in queued:
+            continue
+        queued.add(key)
+        upcoming.append(s)
+
+    if not total:
+        print("No seminars found on the page.")
+        return
     if not upcoming:
-        print("No upcoming seminars found.")
+        print("No new upcoming seminars found.")
         return
 
-    print(f"Found {len(seminars)} seminars on HKU page, {len(upcoming)} upcoming.")
+    print(f"Found {total} seminars on HKU page, {len(upcoming)} upcoming not yet sent.")
     print_seminar_overview(upcoming)
 
-    notifier = SeminarEmailNotifier.from_config_file(
-        os.environ.get("HKU_CONFIG_PATH", "config.json"),
-        tz=HK_TZ,
-        source_url=HKU_SEMINAR_URL,
-        subject_prefix=SUBJECT_PREFIX,
-    )
-    new_count = notifier.send_new_invites(upcoming)
+    new_count = notifier.send_new_invites(upcoming, sent)
     print(f"Completed. Sent {new_count} new invitation(s).")
 
 